@@ -34,6 +34,9 @@ class SequenceGenerator(object):
         sampling=False,
         sampling_topk=-1,
         temperature=1,
+        stop_at_best_eos=False,
+        prune_finished_sents=False,
+        reuse_buffers=False,
     ):
         """Generates translations of a given source sentence.
         Args:
@@ -66,6 +69,17 @@ class SequenceGenerator(object):
             temperature (float, optional): temperature, where values
                 >1.0 produce more uniform samples and values <1.0 produce
                 sharper samples (default: 1.0)
+            stop_at_best_eos (bool, optional): stop generating a sentence as
+                soon as one of its finalized hypotheses scores at least as
+                well as all of its unfinalized ones. Only the best hypothesis
+                is then guaranteed to be returned (default: False)
+            prune_finished_sents (bool, optional): drop finished sentences
+                from the batch instead of decoding them until every sentence
+                is done. Every model's decoder must be able to reorder its
+                incremental state to a smaller batch (default: False)
+            reuse_buffers (bool, optional): keep the token, score and attention
+                buffers of the search between calls to generate() and only
+                reallocate them when a larger batch comes in (default: False)
         """
         self.models = models
         self.pad = tgt_dict.pad()
@@ -104,12 +118,35 @@ class SequenceGenerator(object):
         else:
             self.search = search.BeamSearch(tgt_dict)
         self.diversity_sibling_gamma = diversity_sibling_gamma
+        self.stop_at_best_eos = stop_at_best_eos
+        self.prune_finished_sents = prune_finished_sents
+        self.reuse_buffers = reuse_buffers
+        self._buffers = {}
 
     def cuda(self):
         for model in self.models:
             model.cuda()
         return self
 
+    def _get_buffer(self, name, size, dtype, device):
+        """Returns an uninitialized contiguous tensor of the given size. With
+        reuse_buffers, it is a view of storage kept from earlier calls."""
+        if not self.reuse_buffers:
+            return torch.empty(size, dtype=dtype, device=device)
+        numel = 1
+        for dim in size:
+            numel *= dim
+        buf = self._buffers.get(name)
+        if (
+            buf is None
+            or buf.numel() < numel
+            or buf.dtype != dtype
+            or buf.device != device
+        ):
+            buf = torch.empty(numel, dtype=dtype, device=device)
+            self._buffers[name] = buf
+        return buf[:numel].view(size)
+
     def generate_batched_itr(
         self,
         data_itr,
@@ -235,20 +272,32 @@ class SequenceGenerator(object):
         )
         beam_size = beam_size if beam_size is not None else self.beam_size
         bsz = src_tokens_tensor.size(0)
-        reorder_indices = (
-            torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1).long()
-        )
-        for i, model in enumerate(self.models):
-            encoder_outs[i] = model.encoder.reorder_encoder_out(
-                encoder_out=encoder_outs[i],
-                new_order=reorder_indices.type_as(src_tokens_tensor),
+        # the encoder runs once per source sentence; its outputs are only
+        # replicated for each beam here, and not at all for greedy search
+        if beam_size > 1:
+            reorder_indices = (
+                torch.arange(bsz, device=src_tokens_tensor.device)
+                .view(-1, 1)
+                .repeat(1, beam_size)
+                .view(-1)
             )
+            for i, model in enumerate(self.models):
+                encoder_outs[i] = model.encoder.reorder_encoder_out(
+                    encoder_out=encoder_outs[i], new_order=reorder_indices
+                )
         maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
         # initialize buffers
-        scores = src_tokens_tensor.new(bsz * beam_size, maxlen + 1).float().fill_(0)
-        scores_buf = scores.clone()
-        tokens = src_tokens_tensor.new(bsz * beam_size, maxlen + 2).fill_(self.pad)
-        tokens_buf = tokens.clone()
+        device = src_tokens_tensor.device
+        scores_size = (bsz * beam_size, maxlen + 1)
+        scores = self._get_buffer("scores", scores_size, torch.float, device).fill_(0)
+        scores_buf = self._get_buffer("scores_buf", scores_size, torch.float, device)
+        scores_buf.fill_(0)
+        tokens_size = (bsz * beam_size, maxlen + 2)
+        tokens_dtype = src_tokens_tensor.dtype
+        tokens = self._get_buffer("tokens", tokens_size, tokens_dtype, device)
+        tokens.fill_(self.pad)
+        tokens_buf = self._get_buffer("tokens_buf", tokens_size, tokens_dtype, device)
+        tokens_buf.fill_(self.pad)
         tokens[:, 0] = self.eos
 
         # may differ from input length
@@ -261,11 +310,14 @@ class SequenceGenerator(object):
             else:
                 src_encoding_len = encoder_outs[0]["encoder_out"].size(0)
 
-        attn = scores.new(bsz * beam_size, src_encoding_len, maxlen + 2)
-        attn_buf = attn.clone()
+        attn_size = (bsz * beam_size, src_encoding_len, maxlen + 2)
+        attn = self._get_buffer("attn", attn_size, torch.float, device)
+        attn_buf = self._get_buffer("attn_buf", attn_size, torch.float, device)
 
         # list of completed sentences
         finalized = [[] for i in range(bsz)]
+        # maps each row of the (possibly pruned) batch to its sentence
+        sent_map = list(range(bsz))
         finished = [False for i in range(bsz)]
         worst_finalized = [{"idx": None, "score": -math.inf} for i in range(bsz)]
         num_remaining_sent = bsz
@@ -288,7 +340,7 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
+        def is_finished(sent, unfin_idx, step, unfinalized_scores=None):
             """
             Check whether we've finished generation for a given sentence, by
             comparing the worst score among finalized hypotheses to the best
@@ -300,11 +352,22 @@ class SequenceGenerator(object):
                     return True
                 # stop if the best unfinalized score is worse than the worst
                 # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
+                best_unfinalized_score = unfinalized_scores[unfin_idx].max()
                 if self.normalize_scores:
                     best_unfinalized_score /= (maxlen + 1) ** self.len_penalty
                 if worst_finalized[sent]["score"] >= best_unfinalized_score:
                     return True
+            if self.stop_at_best_eos and len(finalized[sent]) > 0:
+                if step == maxlen or unfinalized_scores is None:
+                    return True
+                # stop if no unfinalized hypothesis can beat the best
+                # finalized one
+                best_finalized_score = max(h["score"] for h in finalized[sent])
+                best_unfinalized_score = unfinalized_scores[unfin_idx].max()
+                if self.normalize_scores:
+                    best_unfinalized_score /= (maxlen + 1) ** self.len_penalty
+                if best_finalized_score >= best_unfinalized_score:
+                    return True
             return False
 
         def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
@@ -324,6 +387,9 @@ class SequenceGenerator(object):
                     scores for each hypothesis
                 unfinalized_scores: A vector containing scores for all
                     unfinalized hypotheses
+
+            Returns:
+                The batch rows of the sentences which finished at this step
             """
             assert bbsz_idx.numel() == eos_scores.numel()
 
@@ -345,12 +411,13 @@ class SequenceGenerator(object):
             if self.normalize_scores:
                 eos_scores /= (step + 1) ** self.len_penalty
 
-            sents_seen = set()
+            sents_seen = {}
             for i, (idx, score) in enumerate(
                 zip(bbsz_idx.tolist(), eos_scores.tolist())
             ):
-                sent = idx // beam_size
-                sents_seen.add(sent)
+                unfin_idx = idx // beam_size
+                sent = sent_map[unfin_idx]
+                sents_seen[sent] = unfin_idx
 
                 def get_hypo():
                     _, alignment = attn_clone[i].max(dim=0)
@@ -376,14 +443,16 @@ class SequenceGenerator(object):
                     )
                     worst_finalized[sent] = {"score": s["score"], "idx": idx}
 
-            # return number of hypotheses finished this step
-            num_finished = 0
-            for sent in sents_seen:
+            # return the sentences finished this step
+            newly_finished = []
+            for sent, unfin_idx in sents_seen.items():
                 # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
+                if not finished[sent] and is_finished(
+                    sent, unfin_idx, step, unfinalized_scores
+                ):
                     finished[sent] = True
-                    num_finished += 1
-            return num_finished
+                    newly_finished.append(unfin_idx)
+            return newly_finished
 
         reorder_state = None
         for step in range(maxlen + 1):  # one extra step for EOS marker
@@ -479,7 +548,9 @@ class SequenceGenerator(object):
                     descending=True,
                     out=(eos_scores, eos_bbsz_idx),
                 )
-                num_remaining_sent -= finalize_hypos(step, eos_bbsz_idx, eos_scores)
+                num_remaining_sent -= len(
+                    finalize_hypos(step, eos_bbsz_idx, eos_scores)
+                )
                 assert num_remaining_sent == 0
                 break
 
@@ -490,6 +561,7 @@ class SequenceGenerator(object):
 
             # finalize hypotheses that end in eos
             eos_mask = cand_indices.eq(self.eos)
+            finished_sents = []
             if step >= self.minlen:
                 # only consider eos when it's among the top beam_size indices
                 torch.masked_select(
@@ -504,15 +576,42 @@ class SequenceGenerator(object):
                         out=eos_scores,
                     )
                     self._apply_eos_constraints(constraints, eos_bbsz_idx, eos_scores)
-                    num_remaining_sent -= finalize_hypos(
+                    finished_sents = finalize_hypos(
                         step, eos_bbsz_idx, eos_scores, cand_scores
                     )
+                    num_remaining_sent -= len(finished_sents)
 
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
             assert step < maxlen
 
+            # remove finished sentences from the batch
+            batch_idxs = None
+            if self.prune_finished_sents and len(finished_sents) > 0:
+                finished_sents = set(finished_sents)
+                kept_rows = [i for i in range(bsz) if i not in finished_sents]
+                new_bsz = len(kept_rows)
+                sent_map = [sent_map[i] for i in kept_rows]
+                batch_idxs = cand_indices.new(kept_rows)
+                eos_mask = eos_mask[batch_idxs]
+                cand_bbsz_idx = (cand_bbsz_idx - bbsz_offsets)[batch_idxs]
+                bbsz_offsets = bbsz_offsets[:new_bsz]
+                cand_bbsz_idx += bbsz_offsets
+                cand_scores = cand_scores[batch_idxs]
+                cand_indices = cand_indices[batch_idxs]
+                if prefix_tokens is not None:
+                    prefix_tokens = prefix_tokens[batch_idxs]
+                scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                scores_buf.resize_as_(scores)
+                tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                tokens_buf.resize_as_(tokens)
+                attn = attn.view(bsz, -1)[batch_idxs].view(
+                    new_bsz * beam_size, attn.size(1), -1
+                )
+                attn_buf.resize_as_(attn)
+                bsz = new_bsz
+
             # set active_mask so that values > cand_size indicate eos hypos
             # and values < cand_size indicate candidate active hypos.
             # After, the min values per row are the top candidate active hypos
@@ -589,9 +688,20 @@ class SequenceGenerator(object):
 
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
+            if batch_idxs is not None:
+                # the decoder states and encoder outputs still have a row for
+                # every hypothesis of the unpruned batch
+                corr = batch_idxs - torch.arange(bsz, device=batch_idxs.device)
+                reorder_state = (
+                    reorder_state.view(-1, beam_size) + corr.unsqueeze(1) * beam_size
+                ).view(-1)
+                for i, model in enumerate(self.models):
+                    encoder_outs[i] = model.encoder.reorder_encoder_out(
+                        encoder_out=encoder_outs[i], new_order=reorder_state
+                    )
 
         # sort by score descending
-        for sent in range(bsz):
+        for sent in range(len(finalized)):
             finalized[sent] = sorted(
                 finalized[sent], key=lambda r: r["score"], reverse=True
             )
@@ -99,6 +99,57 @@ class WeightedLanguagePairDataset(data.language_pair_dataset.LanguagePairDataset
         unweighted_data["weights"] = weights
         return unweighted_data
 
+    @staticmethod
+    def collate_tensors(
+        ids, src_tokens, src_lengths, target, tgt_lengths, weights, pad_idx, eos_idx
+    ):
+        """
+        Same as collate() (with right padded sources) for examples which are
+        already batched as right padded token tensors, e.g. generated
+        translations. The batch is sorted on the tensors' device, so it doesn't
+        need to go through utils.move_to_cuda().
+
+        Args:
+            ids, src_lengths, tgt_lengths, weights: [bsz] tensors
+            src_tokens: [bsz, src_len] right padded tokens
+            target: [bsz, tgt_len] right padded tokens, each ending with EOS
+
+        Returns:
+            the batch, and the [bsz] permutation it applied to the examples,
+            i.e. row i of the batch is example sort_order[i]
+        """
+        # sort by descending source length
+        src_lengths, sort_order = src_lengths.sort(descending=True)
+        # drop padding columns beyond the longest source and target, like
+        # collate() which pads to exactly those lengths
+        ntokens, max_src_len, max_tgt_len = torch.stack(
+            [tgt_lengths.sum(), src_lengths[0], tgt_lengths.max()]
+        ).tolist()
+        src_tokens = src_tokens[:, :max_src_len]
+        target = target[:, :max_tgt_len].index_select(0, sort_order)
+        tgt_lengths = tgt_lengths.index_select(0, sort_order)
+        # move EOS from the end of each target to the beginning
+        prev_output_tokens = torch.cat(
+            [target.new_full((target.size(0), 1), eos_idx), target[:, :-1]], dim=1
+        )
+        positions = torch.arange(target.size(1), device=target.device)
+        prev_output_tokens.masked_fill_(
+            positions.unsqueeze(0) >= tgt_lengths.unsqueeze(1), pad_idx
+        )
+        batch = {
+            "id": ids.index_select(0, sort_order),
+            "nsentences": ids.numel(),
+            "ntokens": ntokens,
+            "net_input": {
+                "src_tokens": src_tokens.index_select(0, sort_order),
+                "src_lengths": src_lengths,
+                "prev_output_tokens": prev_output_tokens,
+            },
+            "target": target,
+            "weights": weights.index_select(0, sort_order),
+        }
+        return batch, sort_order
+
 
 class WeightedBacktranslationDataset(
     data.backtranslation_dataset.BacktranslationDataset
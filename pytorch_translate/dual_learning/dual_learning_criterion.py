@@ -1,12 +1,107 @@
 #!/usr/bin/env python3
 
+import contextlib
 import math
+from typing import Tuple
 
 import torch
-from fairseq import bleu, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
-from pytorch_translate import beam_decode
+from pytorch_translate import beam_decode, utils as pytorch_translate_utils
 from pytorch_translate.data.weighted_data import WeightedLanguagePairDataset
+from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
+
+_INV_LOG2 = 1.0 / math.log(2)
+_MIN_RECONSTRUCTION_WEIGHT = 1e-4
+
+
+def _batched_bleu(refs, hyps, ref_lens, hyp_lens, pad_idx, unk_idx, order=4):
+    """Computes sentence-level BLEU for a batch of (reference, hypothesis)
+    pairs on the device they live on. For each pair this matches
+    fairseq.bleu.Scorer: unk tokens in the reference never match and n-gram
+    matches are clipped by their reference counts.
+
+    Args:
+        refs: [bsz, ref_len] right-padded reference tokens (without EOS)
+        hyps: [bsz, hyp_len] right-padded hypothesis tokens (without EOS)
+        ref_lens, hyp_lens: [bsz] number of non-pad tokens in each row
+
+    Returns:
+        [bsz] FloatTensor of BLEU scores in [0, 1]
+    """
+    bsz = hyps.size(0)
+    # pad out to at least `order` columns so every n-gram order can unfold
+    refs = torch.cat([refs, refs.new_full((bsz, order), pad_idx)], dim=1)
+    hyps = torch.cat([hyps, hyps.new_full((bsz, order), pad_idx)], dim=1)
+    # give reference unks a value that can't appear in the hypothesis
+    refs = refs.masked_fill(refs.eq(unk_idx), -1)
+    # shared by all n-gram orders, which only differ in their valid lengths
+    positions = torch.arange(
+        max(hyps.size(1), refs.size(1)), device=hyps.device
+    ).unsqueeze(0)
+
+    log_precisions = []
+    for n in range(1, order + 1):
+        hyp_ngrams = hyps.unfold(1, n, 1)  # bsz x num_hyp_ngrams x n
+        ref_ngrams = refs.unfold(1, n, 1)  # bsz x num_ref_ngrams x n
+        hyp_mask = positions[:, : hyp_ngrams.size(1)] <= (hyp_lens - n).unsqueeze(1)
+        ref_mask = positions[:, : ref_ngrams.size(1)] <= (ref_lens - n).unsqueeze(1)
+        # occurrences of each hypothesis n-gram in the reference and in the
+        # hypothesis itself
+        ref_counts = (
+            (hyp_ngrams.unsqueeze(2) == ref_ngrams.unsqueeze(1)).all(dim=-1)
+            & ref_mask.unsqueeze(1)
+        ).sum(dim=-1)
+        hyp_counts = (
+            (hyp_ngrams.unsqueeze(2) == hyp_ngrams.unsqueeze(1)).all(dim=-1)
+            & hyp_mask.unsqueeze(1)
+        ).sum(dim=-1)
+        # each distinct n-gram is clipped to min(hyp count, ref count) matches,
+        # shared out over its hyp_counts occurrences
+        matches = (
+            torch.min(ref_counts, hyp_counts).float()
+            / hyp_counts.clamp(min=1).float()
+            * hyp_mask.float()
+        ).sum(dim=1)
+        counts = (hyp_lens - n + 1).clamp(min=1).float()
+        # log(0) = -inf makes the score 0, as in bleu.Scorer
+        log_precisions.append((matches / counts).log())
+
+    log_bleu = torch.stack(log_precisions, dim=1).mean(dim=1)
+    brevity = (1.0 - ref_lens.float() / hyp_lens.clamp(min=1).float()).clamp(max=0.0)
+    return (brevity + log_bleu).exp()
+
+
+@torch.jit.script
+def _append_eos(
+    tokens: Tensor, lengths: Tensor, pad_idx: int, eos_idx: int
+) -> Tuple[Tensor, Tensor]:
+    """Appends EOS to each row of right-padded tokens that doesn't already end
+    with it. Returns the new tokens and lengths."""
+    tokens = torch.cat([tokens, tokens.new_full((tokens.size(0), 1), pad_idx)], dim=1)
+    last_tokens = tokens.gather(1, (lengths - 1).unsqueeze(1)).squeeze(1)
+    lengths = lengths + last_tokens.ne(eos_idx).long()
+    # rows which already end with EOS just get it written again
+    tokens.scatter_(1, (lengths - 1).unsqueeze(1), eos_idx)
+    return tokens, lengths
+
+
+@torch.jit.script
+def _strip_eos(tokens: Tensor, lengths: Tensor, pad_idx: int) -> Tuple[Tensor, Tensor]:
+    """Removes the final token, i.e. EOS, from each row of right-padded tokens.
+    Returns the new tokens and lengths."""
+    lengths = lengths - 1
+    tokens = tokens.scatter(1, lengths.unsqueeze(1), pad_idx)
+    return tokens[:, :-1], lengths
+
+
+@torch.jit.script
+def _total_rewards(
+    forward_reward: float, backward_rewards: Tensor, alpha: float
+) -> Tensor:
+    """Interpolates the forward model's reward with each sentence's backward
+    (reconstruction) reward."""
+    return alpha * forward_reward + (1.0 - alpha) * backward_rewards
 
 
 @register_criterion("unsupervised_criterion")
@@ -24,12 +119,59 @@ class UnsupervisedCriterion(FairseqCriterion):
         self.alpha = args.reward_alpha
         self.remove_eos_at_src = not args.append_eos_to_source
         self.task = task
+        # don't reconstruct the sources when their BLEU has a negligible
+        # weight in the rewards
+        self.skip_reconstruction = 1.0 - self.alpha < _MIN_RECONSTRUCTION_WEIGHT
+        # SequenceGenerators keyed by (model, tgt_dict); the primal and dual
+        # models swap roles between calls so we can't keep one per direction
+        self._generators = {}
+        # side stream for reconstructing the sources with the backward model,
+        # created lazily so that the criterion can be built without a GPU
+        self._generation_stream = None
+
+    def _get_or_build_generator(self, model, tgt_dict, kwargs):
+        """Returns the cached generator for model, only rebuilding it when the
+        generation kwargs change."""
+        key = (id(model), id(tgt_dict))
+        kwargs_key = tuple(sorted(kwargs.items()))
+        cached = self._generators.get(key)
+        if cached is None or cached[0] != kwargs_key:
+            translator_class = beam_decode.SequenceGenerator
+            # only the best hypothesis is used, so beam search can stop as
+            # soon as it is found; the RNN decoders can drop finished
+            # sentences from the batch
+            translator = translator_class(
+                models=[model],
+                tgt_dict=tgt_dict,
+                stop_at_best_eos=True,
+                prune_finished_sents=True,
+                reuse_buffers=True,
+                **kwargs,
+            )
+            if torch.cuda.is_available():
+                translator.cuda()
+            cached = (kwargs_key, translator)
+            self._generators[key] = cached
+        return cached[1]
+
+    def _generation_autocast(self):
+        """Runs beam search in FP16 when this PyTorch provides autocast. With
+        --fp16 the models are already in FP16, so there is nothing to cast.
+        Losses and rewards are computed outside of this context in FP32."""
+        autocast = getattr(torch, "autocast", None)
+        if (
+            autocast is None
+            or not torch.cuda.is_available()
+            or getattr(self.args, "fp16", False)
+        ):
+            return contextlib.suppress()  # no-op
+        return autocast("cuda", dtype=torch.float16)
 
     def _generate_translation(self, model, tgt_dict, sample, **kwargs):
-        translator_class = beam_decode.SequenceGenerator
-        translator = translator_class(models=[model], tgt_dict=tgt_dict, **kwargs)
-        translator.cuda()
-        s = utils.move_to_cuda(sample)
+        translator = self._get_or_build_generator(model, tgt_dict, kwargs)
+        s = sample
+        if torch.cuda.is_available():
+            s = pytorch_translate_utils.move_to_cuda_non_blocking(sample)
 
         # TODO: nbest
         input = s["net_input"]
@@ -45,15 +187,84 @@ class UnsupervisedCriterion(FairseqCriterion):
                 k: v for k, v in input.items() if k in ["src_tokens", "src_lengths"]
             }
         with torch.no_grad():
-            hypos = translator.generate(
-                encoder_input=encoder_input,
-                beam_size=self.args.beam,
-                maxlen=int(self.args.max_len_a * srclen + self.args.max_len_b),
-            )
-            for i, id in enumerate(s["id"]):
-                # remove padding
-                src = utils.strip_pad(input["src_tokens"][i, :], tgt_dict.pad())
-                yield id, src, hypos[i]
+            # only the generate call is autocast: this is a generator, so the
+            # caller's code runs between the yields below
+            with self._generation_autocast():
+                hypos = translator.generate(
+                    encoder_input=encoder_input,
+                    beam_size=self.args.beam,
+                    maxlen=int(self.args.max_len_a * srclen + self.args.max_len_b),
+                )
+            # remove padding, which is on the left of monolingual sources but on
+            # the right of the batches built by this criterion, by slicing out
+            # each row's span of non-pad tokens
+            non_pad = input["src_tokens"].ne(tgt_dict.pad())
+            starts = non_pad.cumsum(dim=1).eq(0).sum(dim=1)
+            spans = torch.stack([starts, starts + non_pad.sum(dim=1)], dim=1)
+            for i, (id, (start, end)) in enumerate(zip(s["id"], spans.tolist())):
+                yield id, input["src_tokens"][i, start:end], hypos[i]
+
+    def _reconstruction_rewards(
+        self,
+        backward_model,
+        src_dict,
+        backward_batch,
+        sort_order,
+        batch_ready,
+        **kwargs,
+    ):
+        """Reconstructs the original sources from the backward batch and
+        returns their sentence-level BLEU, in the order of the samples that
+        the batch was sorted from with `sort_order`. If `batch_ready` is
+        given, generation runs on a side stream once that event has been
+        reached on the current stream."""
+        # use bleu score as reward; reconstruct all the original sources with
+        # a single batched call to the backward model
+        stream = None
+        if batch_ready is not None:
+            if self._generation_stream is None:
+                self._generation_stream = torch.cuda.Stream()
+            stream = self._generation_stream
+            stream.wait_event(batch_ready)
+        # a no-op without a stream
+        with torch.cuda.stream(stream):
+            x_hats = [
+                x_hypos[0]["tokens"]
+                for _, _, x_hypos in self._generate_translation(
+                    backward_model, src_dict, backward_batch, **kwargs
+                )
+            ]
+        if stream is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            for x_hat in x_hats:
+                # x_hats were allocated on the side stream but are consumed here
+                x_hat.record_stream(torch.cuda.current_stream())
+        # generation leaves the model in eval mode
+        backward_model.train()
+        x_hat_tokens, x_hat_lengths = _strip_eos(
+            pad_sequence(x_hats, batch_first=True, padding_value=src_dict.pad()),
+            torch.tensor([x_hat.numel() for x_hat in x_hats], device=sort_order.device),
+            src_dict.pad(),
+        )
+        # the original sources (minus EOS) are the references
+        ref_tokens, ref_lengths = _strip_eos(
+            backward_batch["target"],
+            backward_batch["target"].ne(src_dict.pad()).sum(dim=1),
+            src_dict.pad(),
+        )
+        backward_rewards = _batched_bleu(
+            refs=ref_tokens,
+            hyps=x_hat_tokens,
+            ref_lens=ref_lengths,
+            hyp_lens=x_hat_lengths,
+            pad_idx=src_dict.pad(),
+            unk_idx=src_dict.unk(),
+        )
+        # the rewards follow the order of the backward batch; put them back in
+        # the order of the samples
+        return backward_rewards.new_empty(backward_rewards.size()).index_copy_(
+            0, sort_order, backward_rewards
+        )
 
     def forward(
         self,
@@ -81,111 +292,142 @@ class UnsupervisedCriterion(FairseqCriterion):
             lm_scorer: an LM model eval mode to score psuedo labels in target
                 space.
         """
-        # Generate translations
-        nbest_translations = self._generate_translation(
-            forward_model, tgt_dict, sample, **generate_kwargs
-        )
-
-        forward_samples = []
-        backward_samples = []
-        # TODO (T36875783): load pretrained lm to score
-        lm_score = 0.5
-        eos_index = tgt_dict.eos()
-        for id, src, hypos in nbest_translations:
-            # compute each model's reward
-            forward_reward = lm_score
-            # construct the sample; compute the ce loss
-            # backward_samples need to handle EOS
-            original_src = src
-            bt_src = hypos[0]["tokens"]
-            # add EOS to the target, i.e. original source, since it'll be used
-            # as target
-            if original_src[-1] != eos_index:
-                original_src = torch.cat(
-                    [original_src.cpu(), torch.LongTensor([eos_index])]
-                )
-            # remove EOS in the src is optional
-            if self.remove_eos_at_src:
-                bt_src = bt_src[:-1]
-            backward_sample = {
-                "id": id,
-                "source": bt_src.cpu(),  # first hypo is best hypo
-                "target": original_src.cpu(),
-                "weights": 1.0 - self.alpha,
-            }
-            backward_samples.append(backward_sample)
-            # use bleu score as reward
-            bwd_model_input = utils.move_to_cuda(
-                WeightedLanguagePairDataset.collate(
-                    samples=[backward_sample],
-                    pad_idx=src_dict.pad(),
-                    eos_idx=src_dict.eos(),
+        # none of the rewards or pseudo labelled batches need gradients, only
+        # the two losses computed from them do
+        with torch.no_grad():
+            # Generate translations
+            ids, srcs, hypos = zip(
+                *self._generate_translation(
+                    forward_model, tgt_dict, sample, **generate_kwargs
                 )
             )
-            reconstructed_source = self._generate_translation(
-                backward_model, src_dict, bwd_model_input, **generate_kwargs
+            # first hypo is best hypo
+            hyps = [nbest[0]["tokens"] for nbest in hypos]
+
+            # TODO (T36875783): load pretrained lm to score
+            lm_score = 0.5
+            eos_index = tgt_dict.eos()
+            # pad the sources and best hypotheses once so EOS can be handled for
+            # the whole batch at a time
+            src_tokens = pad_sequence(
+                srcs, batch_first=True, padding_value=src_dict.pad()
+            )
+            src_lengths = torch.tensor(
+                [src.numel() for src in srcs], device=src_tokens.device
             )
-            scorer = bleu.Scorer(src_dict.pad(), src_dict.eos(), src_dict.unk())
-            for _, _, x_hypos in reconstructed_source:
-                x_hat = x_hypos[0]["tokens"][:-1]
-                scorer.add(original_src.int(), x_hat.int().cpu())
-            backward_reward = scorer.score(order=4) / 100.0
-
-            total_reward = (
-                self.alpha * forward_reward + (1.0 - self.alpha) * backward_reward
+            hyp_tokens = pad_sequence(
+                hyps, batch_first=True, padding_value=tgt_dict.pad()
             )
-
-            assert hypos[0]["tokens"][-1] == eos_index, (
-                f"Expected generated translation to have eos (id: "
-                f"{eos_index}) at end, but instead found token id "
-                f"{hypos[0]['tokens'][-1]} at end."
+            hyp_lengths = torch.tensor(
+                [hyp.numel() for hyp in hyps], device=hyp_tokens.device
+            )
+            hyp_last_tokens = hyp_tokens.gather(1, (hyp_lengths - 1).unsqueeze(1))
+            assert hyp_last_tokens.eq(eos_index).all(), (
+                f"Expected generated translations to have eos (id: "
+                f"{eos_index}) at end, but instead found token ids "
+                f"{hyp_last_tokens.squeeze(1).tolist()} at end."
             )
-            forward_samples.append(
-                {
-                    "id": id,
-                    "source": src.cpu(),
-                    "target": hypos[0]["tokens"].cpu(),  # first hypo is best hypo
-                    "weights": total_reward,
-                }
+            # backward samples need to handle EOS: add EOS to the target, i.e.
+            # original source, since it'll be used as target
+            target_tokens, target_lengths = _append_eos(
+                src_tokens, src_lengths, src_dict.pad(), src_dict.eos()
             )
+            # remove EOS in the src is optional
+            if self.remove_eos_at_src:
+                bt_src_tokens, bt_src_lengths = _strip_eos(
+                    hyp_tokens, hyp_lengths, tgt_dict.pad()
+                )
+            else:
+                bt_src_tokens, bt_src_lengths = hyp_tokens, hyp_lengths
+            ids = torch.stack(ids)
 
-        # Now combine pseudo labelled examples to corresponding batch with
-        # rewards factored to weighting of each task's loss
-        agg_loss, agg_sample_size, agg_logging_output = 0.0, 0.0, {}
-        forward_model.train()
-        forward_loss, sample_size, logging_output = self.task.criterion(
-            forward_model,
-            utils.move_to_cuda(
-                WeightedLanguagePairDataset.collate(
-                    samples=forward_samples,
-                    pad_idx=tgt_dict.pad(),
-                    eos_idx=tgt_dict.eos(),
+            # the backward batch is built once, directly from the padded tensors,
+            # and used both to reconstruct the original sources and to compute the
+            # backward model's loss
+            backward_batch, backward_order = (
+                WeightedLanguagePairDataset.collate_tensors(
+                    ids=ids,
+                    src_tokens=bt_src_tokens,
+                    src_lengths=bt_src_lengths,
+                    target=target_tokens,
+                    tgt_lengths=target_lengths,
+                    weights=torch.ones(ids.size(), device=target_tokens.device),
+                    pad_idx=src_dict.pad(),
+                    eos_idx=src_dict.eos(),
                 )
-            ),
+            )
+        batch_ready = None
+        if not self.skip_reconstruction and torch.cuda.is_available():
+            batch_ready = torch.cuda.Event()
+            batch_ready.record()
+        # the backward model's loss doesn't depend on the rewards, so its
+        # forward and backward passes are queued on the default stream first
+        # and run while the sources are reconstructed on a side stream. The
+        # reduced loss doesn't sync; the only sync before generation is the
+        # encoder copying the source lengths, which waits for the batch but
+        # not for the model. The loss values are read after generation.
+        backward_model.train()
+        backward_loss, backward_nll_loss = self.task.criterion.compute_loss(
+            backward_model,
+            backward_model(**backward_batch["net_input"]),
+            backward_batch,
         )
-        agg_loss += forward_loss.detach().item()
-        agg_sample_size += sample_size
-        agg_logging_output["primal"] = logging_output
         # grad would be further scaled when passed back to trainer,
         # which will do the update
-        forward_optimizer.backward(forward_loss)
+        backward_optimizer.backward(backward_loss)
 
-        backward_model.train()
-        backward_loss, sample_size, logging_output = self.task.criterion(
-            backward_model,
-            utils.move_to_cuda(
-                WeightedLanguagePairDataset.collate(
-                    samples=backward_samples,
-                    pad_idx=src_dict.pad(),
-                    eos_idx=src_dict.eos(),
+        with torch.no_grad():
+            if self.skip_reconstruction:
+                # the reconstruction BLEU would barely change the total rewards
+                backward_rewards = torch.zeros(ids.size(), device=target_tokens.device)
+            else:
+                backward_rewards = self._reconstruction_rewards(
+                    backward_model,
+                    src_dict,
+                    backward_batch,
+                    backward_order,
+                    batch_ready,
+                    **generate_kwargs,
                 )
-            ),
+            # compute each model's reward
+            forward_reward = lm_score
+            total_rewards = _total_rewards(forward_reward, backward_rewards, self.alpha)
+            # the rewards are not used as loss weights: the per-example
+            # samples this criterion used to collate stored them under
+            # "weights", which WeightedLanguagePairDataset.collate() ignores,
+            # so both models have always trained with a weight of 1.0. They
+            # are kept on the batch, in batch order, as "rewards".
+            forward_batch, forward_order = WeightedLanguagePairDataset.collate_tensors(
+                ids=ids,
+                src_tokens=src_tokens,
+                src_lengths=src_lengths,
+                target=hyp_tokens,
+                tgt_lengths=hyp_lengths,
+                weights=torch.ones(ids.size(), device=hyp_tokens.device),
+                pad_idx=tgt_dict.pad(),
+                eos_idx=tgt_dict.eos(),
+            )
+            forward_batch["rewards"] = total_rewards.index_select(0, forward_order)
+
+        # Now compute the forward model's loss on the pseudo labelled batch
+        forward_model.train()
+        forward_loss, forward_nll_loss = self.task.criterion.compute_loss(
+            forward_model, forward_model(**forward_batch["net_input"]), forward_batch
         )
+        forward_optimizer.backward(forward_loss)
 
-        agg_loss += backward_loss.data.item()
-        agg_sample_size += sample_size
-        agg_logging_output["dual"] = logging_output
-        backward_optimizer.backward(backward_loss)
+        # the loss values are only read once both backward passes are queued
+        agg_loss, agg_sample_size, agg_logging_output = 0.0, 0.0, {}
+        for key, batch, loss, nll_loss in [
+            ("primal", forward_batch, forward_loss, forward_nll_loss),
+            ("dual", backward_batch, backward_loss, backward_nll_loss),
+        ]:
+            sample_size, logging_output = self.task.criterion.get_logging_output(
+                batch, loss, nll_loss
+            )
+            agg_loss += logging_output["loss"]
+            agg_sample_size += sample_size
+            agg_logging_output[key] = logging_output
         return agg_loss, agg_sample_size, agg_logging_output
 
     @staticmethod
@@ -196,21 +438,18 @@ class UnsupervisedCriterion(FairseqCriterion):
             if key in logging_outputs[0].keys():
                 return logging_outputs[0][key]
             else:
-                return sum(
-                    log[key] if key in log else 0
-                    for _, log in logging_outputs[0].items()
-                )
+                return sum(log.get(key, 0) for log in logging_outputs[0].values())
 
         loss_sum = get_logging_output("loss")
         ntokens = get_logging_output("ntokens")
         nsentences = get_logging_output("nsentences")
         sample_size = get_logging_output("sample_size")
         agg_output = {
-            "loss": loss_sum / sample_size / math.log(2),
+            "loss": loss_sum / sample_size * _INV_LOG2,
             "ntokens": ntokens,
             "nsentences": nsentences,
             "sample_size": sample_size,
         }
         if sample_size != ntokens:
-            agg_output["nll_loss"] = loss_sum / ntokens / math.log(2)
+            agg_output["nll_loss"] = loss_sum / ntokens * _INV_LOG2
         return agg_output
@@ -3,10 +3,11 @@
 from collections import OrderedDict
 
 import torch
-from fairseq import optim, utils
+from fairseq import optim
 from fairseq.criterions import CRITERION_REGISTRY
 from fairseq.data import LanguagePairDataset, RoundRobinZipDatasets
 from fairseq.tasks import FairseqTask, register_task
+from pytorch_translate import utils as pytorch_translate_utils
 from pytorch_translate.data import (
     dictionary as pytorch_translate_dictionary,
     utils as data_utils,
@@ -339,7 +340,7 @@ class DualLearningTask(FairseqTask):
     def _prepare_sample(self, sample):
         if sample is None or len(sample) == 0:
             return None
-        return utils.move_to_cuda(sample)
+        return pytorch_translate_utils.move_to_cuda_non_blocking(sample)
 
     def _get_src_dict(self, model_key):
         if model_key == "primal":
@@ -154,3 +154,92 @@ class TestBeamDecode(unittest.TestCase):
         np.testing.assert_allclose(
             actual=logprobs_out.view(-1, 5).numpy(), desired=logprobs.numpy(), atol=1e-5
         )
+
+    def test_stop_at_best_eos_generate(self):
+        """
+        Stopping as soon as the best hypothesis is finalized shouldn't change
+        what the best hypothesis is.
+        """
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        src_tokens = torch.LongTensor([[0, 0, 0], [0, 0, 0]])
+        src_lengths = torch.LongTensor([3, 3])
+        encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3
+        )
+        hypos = translator.generate(encoder_input, maxlen=7)
+        translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3, stop_at_best_eos=True
+        )
+        best_hypos = translator.generate(encoder_input, maxlen=7)
+        for hypo, best_hypo in zip(hypos, best_hypos):
+            np.testing.assert_array_equal(
+                hypo[0]["tokens"].numpy(), best_hypo[0]["tokens"].numpy()
+            )
+
+    def test_prune_finished_sents_generate(self):
+        """
+        Dropping finished sentences from the batch shouldn't change the
+        generated hypotheses.
+        """
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        src_tokens = torch.LongTensor([[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+        src_lengths = torch.LongTensor([3, 3, 3])
+        encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3
+        )
+        hypos = translator.generate(encoder_input, maxlen=7)
+        translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3, prune_finished_sents=True
+        )
+        pruned_hypos = translator.generate(encoder_input, maxlen=7)
+        for sent_hypos, sent_pruned_hypos in zip(hypos, pruned_hypos):
+            self.assertEqual(len(sent_hypos), len(sent_pruned_hypos))
+            for hypo, pruned_hypo in zip(sent_hypos, sent_pruned_hypos):
+                np.testing.assert_array_equal(
+                    hypo["tokens"].numpy(), pruned_hypo["tokens"].numpy()
+                )
+                np.testing.assert_almost_equal(
+                    hypo["score"], pruned_hypo["score"], decimal=5
+                )
+
+    def test_reuse_buffers_generate(self):
+        """
+        Reusing the search buffers across calls, with a smaller batch on the
+        second call, shouldn't change the generated hypotheses.
+        """
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        src_tokens = torch.LongTensor([[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+        src_lengths = torch.LongTensor([3, 3, 3])
+        encoder_inputs = [
+            {"src_tokens": src_tokens, "src_lengths": src_lengths},
+            {"src_tokens": src_tokens[1:, 1:], "src_lengths": src_lengths[1:] - 1},
+        ]
+        translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3
+        )
+        reusing_translator = beam_decode.SequenceGenerator(
+            [model], task.target_dictionary, beam_size=3, reuse_buffers=True
+        )
+        for encoder_input in encoder_inputs:
+            hypos = translator.generate(encoder_input, maxlen=7)
+            reused_hypos = reusing_translator.generate(encoder_input, maxlen=7)
+            for sent_hypos, sent_reused_hypos in zip(hypos, reused_hypos):
+                self.assertEqual(len(sent_hypos), len(sent_reused_hypos))
+                for hypo, reused_hypo in zip(sent_hypos, sent_reused_hypos):
+                    np.testing.assert_array_equal(
+                        hypo["tokens"].numpy(), reused_hypo["tokens"].numpy()
+                    )
+                    np.testing.assert_almost_equal(
+                        hypo["score"], reused_hypo["score"], decimal=5
+                    )
@@ -5,13 +5,17 @@ import tempfile
 import unittest
 
 import numpy as np
+import torch
 from fairseq.data import LanguagePairDataset, NoisingDataset
 from fairseq.data.concat_dataset import ConcatDataset
 from fairseq.data.noising import UnsupervisedMTNoising
 from pytorch_translate import preprocess
 from pytorch_translate.data import char_data, data, dictionary
+from pytorch_translate.data.weighted_data import WeightedLanguagePairDataset
+from pytorch_translate.dual_learning.dual_learning_criterion import _append_eos
 from pytorch_translate.tasks import pytorch_translate_task as tasks
 from pytorch_translate.test import utils as test_utils
+from torch.nn.utils.rnn import pad_sequence
 
 
 class TestLoadData(unittest.TestCase):
@@ -296,3 +300,64 @@ class TestInMemoryNumpyDataset(unittest.TestCase):
             assert len(sampled_chars_list) == len(orig_chars_list)
             for sampled_chars, orig_chars in zip(sampled_chars_list, orig_chars_list):
                 assert all(sampled_chars.numpy() == orig_chars.numpy())
+
+
+class TestWeightedLanguagePairDataset(unittest.TestCase):
+    def test_collate_tensors(self):
+        """
+        collate_tensors() on padded tensors should build the same batch as
+        collate() on the individual examples.
+        """
+        pad, eos = 1, 2
+        sources = [[4, 5, 6, 7], [4, 5], [8, 9, 10, 11, 12], [6, 7, 8]]
+        # targets with and without a trailing EOS; the longest has one, so
+        # appending EOS to the padded tensor leaves an extra padding column
+        targets = [[5, 6, eos], [7, 8, 9], [4, eos], [9, 10, 11, 12, eos]]
+        weights = [0.5, 1.0, 0.25, 0.75]
+        samples = [
+            {
+                "id": i,
+                "source": torch.LongTensor(source),
+                "target": torch.LongTensor(
+                    target if target[-1] == eos else target + [eos]
+                ),
+                "weight": weight,
+            }
+            for i, (source, target, weight) in enumerate(zip(sources, targets, weights))
+        ]
+        expected = WeightedLanguagePairDataset.collate(samples, pad, eos)
+
+        target, tgt_lengths = _append_eos(
+            pad_sequence(
+                [torch.LongTensor(t) for t in targets],
+                batch_first=True,
+                padding_value=pad,
+            ),
+            torch.LongTensor([len(t) for t in targets]),
+            pad,
+            eos,
+        )
+        batch, sort_order = WeightedLanguagePairDataset.collate_tensors(
+            ids=torch.arange(len(samples)),
+            src_tokens=pad_sequence(
+                [torch.LongTensor(s) for s in sources],
+                batch_first=True,
+                padding_value=pad,
+            ),
+            src_lengths=torch.LongTensor([len(s) for s in sources]),
+            target=target,
+            tgt_lengths=tgt_lengths,
+            weights=torch.FloatTensor(weights),
+            pad_idx=pad,
+            eos_idx=eos,
+        )
+
+        self.assertEqual(sort_order.tolist(), expected["id"].tolist())
+        for key in ["ntokens", "nsentences"]:
+            self.assertEqual(batch[key], expected[key])
+        for key in ["id", "target", "weights"]:
+            self.assertEqual(batch[key].tolist(), expected[key].tolist())
+        for key in ["src_tokens", "src_lengths", "prev_output_tokens"]:
+            self.assertEqual(
+                batch["net_input"][key].tolist(), expected["net_input"][key].tolist()
+            )
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import math
+import unittest
+from unittest.mock import patch
+
+import torch
+from pytorch_translate.dual_learning import dual_learning_criterion
+from pytorch_translate.dual_learning.dual_learning_criterion import (
+    UnsupervisedCriterion,
+    _append_eos,
+    _batched_bleu,
+    _strip_eos,
+)
+from pytorch_translate.tasks import pytorch_translate_task as tasks
+from pytorch_translate.test import utils as test_utils
+from pytorch_translate.weighted_criterions import (
+    WeightedLabelSmoothedCrossEntropyCriterion,
+)
+
+
+class TestBatchedBleu(unittest.TestCase):
+    def test_batched_bleu(self):
+        pad, unk = 1, 3
+        refs = torch.LongTensor(
+            [
+                [4, 5, 6, 7, 8, 9],  # exact match
+                [4, 5, 6, 7, 8, 9],  # hypothesis too short
+                [4, 5, 6, 7, 1, 1],  # no 4-gram match
+                [4, 5, 6, 7, 8, 1],  # reference unk never matches
+                [4, 3, 6, 7, 8, 1],
+            ]
+        )
+        hyps = torch.LongTensor(
+            [
+                [4, 5, 6, 7, 8, 9],
+                [4, 5, 6, 7, 8, 1],
+                [4, 5, 7, 6, 1, 1],
+                [4, 5, 6, 7, 8, 1],
+                [4, 3, 6, 7, 8, 1],
+            ]
+        )
+        ref_lens = torch.LongTensor([6, 6, 4, 5, 5])
+        hyp_lens = torch.LongTensor([6, 5, 4, 5, 5])
+        scores = _batched_bleu(refs, hyps, ref_lens, hyp_lens, pad, unk)
+        expected = [1.0, math.exp(1 - 6 / 5), 0.0, 1.0, 0.0]
+        for score, expected_score in zip(scores.tolist(), expected):
+            self.assertAlmostEqual(score, expected_score, places=5)
+
+
+class TestEosHelpers(unittest.TestCase):
+    def test_append_and_strip_eos(self):
+        pad, eos = 1, 2
+        tokens = torch.LongTensor([[4, 5, 2, 1], [4, 1, 1, 1], [4, 5, 6, 7]])
+        lengths = torch.LongTensor([3, 1, 4])
+        eos_tokens, eos_lengths = _append_eos(tokens, lengths, pad, eos)
+        # rows which already end with EOS are unchanged
+        self.assertEqual(
+            eos_tokens.tolist(),
+            [[4, 5, 2, 1, 1], [4, 2, 1, 1, 1], [4, 5, 6, 7, 2]],
+        )
+        self.assertEqual(eos_lengths.tolist(), [3, 2, 5])
+        stripped_tokens, stripped_lengths = _strip_eos(eos_tokens, eos_lengths, pad)
+        self.assertEqual(
+            stripped_tokens.tolist(), [[4, 5, 1, 1], [4, 1, 1, 1], [4, 5, 6, 7]]
+        )
+        self.assertEqual(stripped_lengths.tolist(), [2, 1, 4])
+
+
+class _BackwardOptimizer:
+    """Stands in for the trainer's optimizer, which only has to backprop."""
+
+    def backward(self, loss):
+        loss.backward()
+
+
+class TestUnsupervisedCriterion(unittest.TestCase):
+    def setUp(self):
+        self.test_args = test_utils.ModelParamsDict()
+        self.test_args.label_smoothing = 0.0
+        self.test_args.beam = 2
+        self.test_args.max_len_a = 0
+        self.test_args.max_len_b = 8
+        _, self.src_dict, self.tgt_dict = test_utils.prepare_inputs(self.test_args)
+        self.forward_model = tasks.DictionaryHolderTask(
+            self.src_dict, self.tgt_dict
+        ).build_model(self.test_args)
+        self.backward_model = tasks.DictionaryHolderTask(
+            self.tgt_dict, self.src_dict
+        ).build_model(self.test_args)
+        self.task = tasks.DictionaryHolderTask(self.src_dict, self.tgt_dict)
+        self.task.use_char_source = False
+        self.task.criterion = WeightedLabelSmoothedCrossEntropyCriterion(
+            self.test_args, self.task
+        )
+        # a left padded monolingual batch, sorted by descending source length
+        # like the ones LanguagePairDataset builds, whose ids aren't in order
+        pad, eos = self.src_dict.pad(), self.src_dict.eos()
+        self.sources = {
+            7: [10, 11, 12, 13, eos],
+            3: [14, 15, 16, eos],
+            5: [17, 18, eos],
+        }
+        self.sample = {
+            "id": torch.LongTensor([7, 3, 5]),
+            "net_input": {
+                "src_tokens": torch.LongTensor(
+                    [
+                        [10, 11, 12, 13, eos],
+                        [pad, 14, 15, 16, eos],
+                        [pad, pad, 17, 18, eos],
+                    ]
+                ),
+                "src_lengths": torch.LongTensor([5, 4, 3]),
+            },
+        }
+
+    def _run_criterion(self, reward_alpha, append_eos_to_source):
+        """Runs the criterion, with BLEU replaced by the reference length, and
+        returns the forward and backward batches it computed losses on."""
+        self.test_args.reward_alpha = reward_alpha
+        self.test_args.append_eos_to_source = append_eos_to_source
+        criterion = UnsupervisedCriterion(self.test_args, self.task)
+        with patch.object(
+            self.task.criterion,
+            "compute_loss",
+            wraps=self.task.criterion.compute_loss,
+        ) as compute_loss, patch.object(
+            dual_learning_criterion,
+            "_batched_bleu",
+            side_effect=lambda refs, hyps, ref_lens, **kwargs: ref_lens.float(),
+        ) as batched_bleu:
+            criterion(
+                self.sample,
+                self.forward_model,
+                _BackwardOptimizer(),
+                self.tgt_dict,
+                self.backward_model,
+                _BackwardOptimizer(),
+                self.src_dict,
+            )
+        # the backward model's loss is computed first
+        (_, _, backward_batch), (_, _, forward_batch) = [
+            call[0] for call in compute_loss.call_args_list
+        ]
+        return forward_batch, backward_batch, batched_bleu
+
+    def _check_batches(self, forward_batch, backward_batch, append_eos_to_source):
+        pad, eos = self.src_dict.pad(), self.src_dict.eos()
+        for batch in [forward_batch, backward_batch]:
+            self.assertEqual(sorted(batch["id"].tolist()), [3, 5, 7])
+            self.assertEqual(batch["target"].size(0), 3)
+            self.assertEqual(
+                batch["net_input"]["prev_output_tokens"].size(),
+                batch["target"].size(),
+            )
+            self.assertEqual(batch["weights"].tolist(), [1.0, 1.0, 1.0])
+        for i, id in enumerate(forward_batch["id"].tolist()):
+            # the left padding is stripped and the sources are right padded
+            src_tokens = forward_batch["net_input"]["src_tokens"][i]
+            src_length = forward_batch["net_input"]["src_lengths"][i]
+            self.assertEqual(src_tokens[:src_length].tolist(), self.sources[id])
+            self.assertTrue(src_tokens[src_length:].eq(pad).all())
+        self.assertEqual(backward_batch["target"].size(1), 5)
+        for i, id in enumerate(backward_batch["id"].tolist()):
+            # the original sources, which already end with EOS, are the targets
+            target = backward_batch["target"][i]
+            self.assertEqual(target[target.ne(pad)].tolist(), self.sources[id])
+            src_tokens = backward_batch["net_input"]["src_tokens"][i]
+            src_length = backward_batch["net_input"]["src_lengths"][i]
+            self.assertEqual(
+                src_tokens[src_length - 1].item() == eos, append_eos_to_source
+            )
+
+    def test_forward(self):
+        reward_alpha = 0.25
+        for append_eos_to_source in [False, True]:
+            forward_batch, backward_batch, batched_bleu = self._run_criterion(
+                reward_alpha, append_eos_to_source
+            )
+            self._check_batches(forward_batch, backward_batch, append_eos_to_source)
+            batched_bleu.assert_called_once()
+            # each sample's reward comes from its own reference length
+            for id, reward in zip(
+                forward_batch["id"].tolist(), forward_batch["rewards"].tolist()
+            ):
+                expected_reward = reward_alpha * 0.5 + (1.0 - reward_alpha) * (
+                    len(self.sources[id]) - 1
+                )
+                self.assertAlmostEqual(reward, expected_reward, places=5)
+
+    def test_forward_skip_reconstruction(self):
+        forward_batch, backward_batch, batched_bleu = self._run_criterion(
+            reward_alpha=1.0, append_eos_to_source=False
+        )
+        self._check_batches(forward_batch, backward_batch, False)
+        batched_bleu.assert_not_called()
+        self.assertEqual(forward_batch["rewards"].tolist(), [0.5, 0.5, 0.5])
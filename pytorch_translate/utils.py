@@ -171,6 +171,27 @@ def maybe_cuda(t):
     return t
 
 
+def move_to_cuda_non_blocking(sample):
+    """Like fairseq.utils.move_to_cuda(), but issues the host-to-device
+    copies with `non_blocking=True`. Copies from pinned memory then overlap
+    with work already queued on the current stream; copies from pageable
+    memory silently fall back to synchronous ones."""
+    if len(sample) == 0:
+        return {}
+
+    def _move_to_cuda(maybe_tensor):
+        if torch.is_tensor(maybe_tensor):
+            return maybe_tensor.cuda(non_blocking=True)
+        elif isinstance(maybe_tensor, dict):
+            return {key: _move_to_cuda(value) for key, value in maybe_tensor.items()}
+        elif isinstance(maybe_tensor, list):
+            return [_move_to_cuda(x) for x in maybe_tensor]
+        else:
+            return maybe_tensor
+
+    return _move_to_cuda(sample)
+
+
 def average_tensors(tensor_list, norm_fn=None, weights=None):
     """Averages a list of tensors.
 
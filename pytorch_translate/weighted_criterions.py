@@ -26,6 +26,16 @@ class WeightedLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
 
     def forward(self, model, sample, reduce=True):
         net_output = model(**sample["net_input"])
+        loss, nll_loss = self.compute_loss(model, net_output, sample, reduce=reduce)
+        sample_size, logging_output = self.get_logging_output(
+            sample, loss, nll_loss, reduce=reduce
+        )
+        return loss, sample_size, logging_output
+
+    def compute_loss(self, model, net_output, sample, reduce=True):
+        """Computes the weighted loss and NLL loss. With reduce, this doesn't
+        sync with the device, so the backward pass can be queued before
+        get_logging_output() reads their values."""
         lprobs = model.get_normalized_probs(net_output, log_probs=True)
         assert "weights" in sample, "Need to specify weights for examples."
         weights = sample["weights"].unsqueeze(1).unsqueeze(2)
@@ -34,14 +44,20 @@ class WeightedLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         lprobs = lprobs.view(-1, lprobs.size(-1))
         target = model.get_targets(sample, net_output).view(-1, 1)
         non_pad_mask = target.ne(self.padding_idx)
-        nll_loss = -lprobs.gather(dim=-1, index=target)[non_pad_mask]
-        smooth_loss = -lprobs.sum(dim=-1, keepdim=True)[non_pad_mask]
+        nll_loss = -lprobs.gather(dim=-1, index=target)
+        smooth_loss = -lprobs.sum(dim=-1, keepdim=True)
         if reduce:
-            nll_loss = nll_loss.sum()
-            smooth_loss = smooth_loss.sum()
+            # selecting with the mask would sync to size the result
+            nll_loss = nll_loss.masked_fill(~non_pad_mask, 0.0).sum()
+            smooth_loss = smooth_loss.masked_fill(~non_pad_mask, 0.0).sum()
+        else:
+            nll_loss = nll_loss[non_pad_mask]
+            smooth_loss = smooth_loss[non_pad_mask]
         eps_i = self.eps / lprobs.size(-1)
         loss = (1.0 - self.eps) * nll_loss + eps_i * smooth_loss
+        return loss, nll_loss
 
+    def get_logging_output(self, sample, loss, nll_loss, reduce=True):
         sample_size = (
             sample["target"].size(0) if self.args.sentence_avg else sample["ntokens"]
         )
@@ -52,7 +68,7 @@ class WeightedLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             "nsentences": sample["target"].size(0),
             "sample_size": sample_size,
         }
-        return loss, sample_size, logging_output
+        return sample_size, logging_output
 
     @classmethod
     def aggregate_logging_outputs(cls, logging_outputs):